@@ -1,25 +1,49 @@
 #!/usr/bin/env python3
 """
 Usage:
-    - pip install click pillow
+    - pip install click numpy pypdfium2
     - ./publish.py --help
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import hashlib
+import mmap
+import os
 from pathlib import Path
 import re
 import shlex
 import shutil
 import subprocess
 import sys
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Set, Tuple
 
 import click
-from PIL import Image, ImageChops
+import numpy as np
+import pypdfium2 as pdfium
 
 here = Path(__file__).parent
 
 AUXDIR = "tmp"
 
+_COMMENT_RE = re.compile(r"(?<!\\)((?:\\\\)*%).+")
+
+# TeX wraps log lines at a fixed column, so a line break may appear anywhere
+# in a file path and even mid-word in the "not found" tail. The captures allow
+# them and matches are unwrapped below.
+_NOT_FOUND = b"\n?".join([b"'", b" ?", b"n", b"o", b"t", b" ?", b"f", b"o", b"u", b"n", b"d"])
+_MISSING_RE = re.compile(
+    rb"LaTeX (?:Error|Warning): File `(?P<plain>[^']+?)" + _NOT_FOUND +
+    rb"|Failed to find one or more bibliography files:\s*'(?P<bib>[^']+?)'"
+    rb"|Missing input file: '`?(?P<input>[^'\n]+?)'"
+)
+
+_REFERENCE_RE = re.compile(
+    r"\\(?:input|include|includegraphics(?:\[[^\]]*\])?|bibliography|addbibresource)"
+    r"\{([^}]+)\}"
+)
+
+
 def dist_dir(paper: Path) -> Path:
     return paper.parent / "dist"
 
@@ -77,7 +101,7 @@ def run(paper, clean):
     _init(paper)
     _collect(paper)
     _squash_comments(paper)
-    proc, _ = _compile(dist(paper))
+    log_dir, _ = _compile(dist(paper))
     shutil.rmtree(dist_dir(paper) / AUXDIR / "diff", ignore_errors=True)
     ok = _compare(
         paper.with_suffix(".pdf"),
@@ -86,10 +110,7 @@ def run(paper, clean):
     )
 
     if not ok:
-        print("📋 latexmk stdout")
-        print(proc.stdout)
-        print("📋 latexmk stderr")
-        print(proc.stderr)
+        _print_logs(log_dir)
         print("❗ Failed.")
 
 
@@ -106,11 +127,13 @@ def init(paper):
 @paper_argument
 def collect(paper):
     """
-    This step tries to compile the distribution,
-    detects error messages complaining about missing files,
-    copies them over, and then tries again. This makes sure
-    that no unused files are included in the final distribution,
-    which would otherwise be common if your data folder also includes code.
+    This step first copies all files that the main document references
+    outside of comments, following \\input and \\include subdocuments,
+    then compiles the distribution, detects error messages complaining
+    about still-missing files, copies them over, and tries again. This
+    makes sure that no unused files are included in the final
+    distribution, which would otherwise be common if your data folder
+    also includes code.
     """
     _collect(paper)
 
@@ -131,12 +154,9 @@ def compile(paper):
     This step runs latexmk on dist/paper.tex again
     after comments have been stripped in the previous step.
     """
-    proc, missing = _compile(dist(paper))
+    log_dir, missing = _compile(dist(paper))
 
-    print("📋 latexmk stdout")
-    print(proc.stdout)
-    print("📋 latexmk stderr")
-    print(proc.stderr)
+    _print_logs(log_dir)
 
     if missing:
         print("❗ Missing the following files:")
@@ -155,11 +175,17 @@ def compile(paper):
     "--dist", "distfile", type=click.Path(exists=True), help="override dist pdf"
 )
 @click.option("--tmpdir", help="override page image directory", type=click.Path())
-def compare(paper, srcfile, distfile, tmpdir):
+@click.option(
+    "--full-res",
+    is_flag=True,
+    help="Compare at 150 dpi in color instead of 72 dpi grayscale.",
+)
+def compare(paper, srcfile, distfile, tmpdir, full_res):
     """
     This step renders both your source PDF and the distribution PDF
-    into PNG files and compares them visually. This ensures that the
-    distribution reproduces your paper exactly.
+    page by page and compares them visually. This ensures that the
+    distribution reproduces your paper exactly. Differing pages are
+    written to the page image directory for inspection.
     """
     if srcfile:
         a = Path(srcfile)
@@ -185,20 +211,21 @@ def compare(paper, srcfile, distfile, tmpdir):
             )
         shutil.rmtree(tmpdir)
 
-    _compare(a, b, tmpdir)
+    _compare(a, b, tmpdir, full_res)
 
 
 def _init(paper: Path) -> None:
     dist_dir(paper).mkdir(exist_ok=True)
     if not dist(paper).exists():
-        shutil.copy(paper, dist(paper))
+        shutil.copy2(paper, dist(paper))
     print(f"✅ Initialized {dist_dir(paper)}.")
 
 
-def _compile(paper: Path) -> Tuple[subprocess.CompletedProcess, List[str]]:
+def _compile(paper: Path) -> Tuple[Path, List[str]]:
     cmd = [
         "latexmk",
         "-pdf",
+        "-f",
         "-recorder-",
         "-shell-escape",
         "-interaction=nonstopmode",
@@ -206,94 +233,250 @@ def _compile(paper: Path) -> Tuple[subprocess.CompletedProcess, List[str]]:
         paper.name,
     ]
     print(f"🔨 Running {shlex.join(cmd)}...")
-    proc = subprocess.run(cmd, cwd=paper.parent, capture_output=True, text=True)
-
     log_dir = paper.parent / AUXDIR
     log_dir.mkdir(parents=True, exist_ok=True)
-    (log_dir / "latexmk-stdout.txt").write_text(proc.stdout)
-    (log_dir / "latexmk-stderr.txt").write_text(proc.stderr)
-
-    # newlines may be anywhere in file paths, so we strip them.
-    stdout = (proc.stdout + proc.stderr).replace("\n", "")
-    missing = sorted(
-        set(
-            re.findall(r"LaTeX (?:Error|Warning): File `(.+?)' ?not ?found", stdout)
-            + re.findall(
-                r"Failed to find one or more bibliography files:\s*'(.+?)'", stdout
-            )
-            + re.findall(
-                r"Missing input file: '`?(.+?)'", stdout
-            )
-        )
-    )
-    return proc, missing
+    with (
+        open(log_dir / "latexmk-stdout.txt", "wb") as stdout,
+        open(log_dir / "latexmk-stderr.txt", "wb") as stderr,
+    ):
+        subprocess.run(cmd, cwd=paper.parent, stdout=stdout, stderr=stderr)
+
+    missing = set()
+    for log in ("latexmk-stdout.txt", "latexmk-stderr.txt"):
+        if (log_dir / log).stat().st_size == 0:
+            continue  # mmap rejects empty files
+        with open(log_dir / log, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in _MISSING_RE.finditer(mm):
+                    missing.add(
+                        match.group(match.lastgroup).replace(b"\n", b"").decode()
+                    )
+    return log_dir, sorted(missing)
+
+
+def _print_logs(log_dir: Path) -> None:
+    print("📋 latexmk stdout")
+    print((log_dir / "latexmk-stdout.txt").read_text())
+    print("📋 latexmk stderr")
+    print((log_dir / "latexmk-stderr.txt").read_text())
+
+
+@functools.lru_cache(maxsize=None)
+def _list_dir(path: Path) -> Dict[str, bool]:
+    """Map a directory's entries to whether they are regular files."""
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.is_file() for entry in entries}
+    except FileNotFoundError:
+        return {}
+
+
+def _referenced_files(paper: Path) -> List[str]:
+    """Statically scan the main document for files it references,
+    following \\input and \\include subdocuments transitively."""
+    refs: Set[str] = set()
+    queue = [paper]
+    seen: Set[Path] = set()
+    while queue:
+        file = queue.pop()
+        if file in seen or not file.is_file():
+            continue
+        seen.add(file)
+        try:
+            contents = file.read_text()
+        except UnicodeDecodeError:
+            continue
+        for line in contents.splitlines():
+            if "%" in line:
+                line = _COMMENT_RE.sub(r"\1", line)
+            for match in _REFERENCE_RE.finditer(line):
+                for ref in match[1].split(","):
+                    ref = ref.strip()
+                    refs.add(ref)
+                    sub = src_dir(paper) / ref
+                    queue.append(sub if sub.suffix else sub.with_suffix(".tex"))
+    return sorted(refs)
+
+
+def _copy_missing(
+    paper: Path, files: List[str], copied: Set[Path], overwrite: bool = True
+) -> int:
+    """Copy source files into dist/, resolving missing file extensions.
+
+    Returns the number of files copied; references that cannot be found
+    in the source tree and files already copied earlier are skipped.
+    With overwrite=False, files that already exist in dist/ are left
+    untouched (e.g. because their comments have been squashed).
+    """
+    pending: List[Tuple[Path, Path]] = []
+    for file in files:
+        src_file = src_dir(paper) / file
+        dst_file = dist_dir(paper) / file
+        entries = _list_dir(src_file.parent)
+        if src_file.name not in entries:
+            prefix = f"{src_file.name}."
+            for name, is_file in entries.items():
+                # file extension missing
+                if not is_file or not name.startswith(prefix):
+                    continue
+                src_file = src_file.with_name(name)
+                dst_file = dst_file.with_name(name)
+                if not dst_file.exists():
+                    break
+        if not src_file.is_file() or dst_file in copied:
+            continue
+        if dst_file.exists():
+            if not overwrite:
+                continue
+            src_stat = src_file.stat()
+            dst_stat = dst_file.stat()
+            # copy2 preserves timestamps, so this means "already copied".
+            if (src_stat.st_mtime, src_stat.st_size) == (
+                dst_stat.st_mtime,
+                dst_stat.st_size,
+            ):
+                copied.add(dst_file)
+                continue
+        copied.add(dst_file)
+        pending.append((src_file, dst_file))
+
+    for parent in {dst_file.parent for _, dst_file in pending}:
+        parent.mkdir(parents=True, exist_ok=True)
+    for src_file, dst_file in pending:
+        print(f"📄 Copy missing file {src_file.relative_to(src_dir(paper))}...")
+        shutil.copy2(src_file, dst_file)
+    return len(pending)
 
 
 def _collect(paper: Path) -> None:
-    runs = 0
+    copied: Set[Path] = set()
+
+    print("🔎 Scanning TeX sources for referenced files...")
+    _copy_missing(paper, _referenced_files(paper), copied, overwrite=False)
 
+    runs = 0
     while True:
         runs += 1
-        proc, missing = _compile(dist(paper))
-        if missing:
-            for file in missing:
-                src_file = src_dir(paper) / file
-                dst_file = dist_dir(paper) / file
-                if not src_file.exists():
-                    for src_file in src_file.parent.glob(f"{src_file.name}.*"):
-                        # file extension missing
-                        if not src_file.is_file():
-                            continue
-                        dst_file = dst_file.with_name(src_file.name)
-                        if not dst_file.exists():
-                            break
-                print(f"📄 Copy missing file {src_file.relative_to(src_dir(paper))}...")
-                    
-                dst_file.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy(src_file, dst_file)
-        else:
+        _, missing = _compile(dist(paper))
+        if not missing:
             print(f"✅ latexmk finished after {runs} iterations.")
             return
+        if not _copy_missing(paper, missing, copied):
+            print("❗ Could not resolve the following files:")
+            for x in missing:
+                print(f" - {x}")
+            return
+
+
+def _iter_tex(root: Path) -> Iterator[Path]:
+    """Walk a directory tree for .tex files without stat calls per entry."""
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _iter_tex(Path(entry.path))
+        elif entry.name.endswith(".tex"):
+            yield Path(entry.path)
+
+
+def _squash_one(file: Path) -> int:
+    lines = []
+    n = 0
+    for line in file.read_text().splitlines(keepends=True):
+        # "%" in line is a C-level memchr, so the regex engine only
+        # ever sees the few lines that actually contain a comment.
+        if "%" in line:
+            line, subs = _COMMENT_RE.subn(r"\1", line)
+            n += subs
+        lines.append(line)
+    file.write_text("".join(lines))
+    return n
 
 
 def _squash_comments(paper: Path) -> None:
-    tex_files = list(dist_dir(paper).glob("**/*.tex"))
+    tex_files = list(_iter_tex(dist_dir(paper)))
     print(f"🧹 Removing comments from {len(tex_files)} tex files...")
-    total = 0
-    for file in tex_files:
-        contents = file.read_text()
-        contents, n = re.subn(r"(?<!\\)((?:\\\\)*%).+", r"\1", contents)
-        file.write_text(contents)
-        total += n
+    with ThreadPoolExecutor() as executor:
+        total = sum(executor.map(_squash_one, tex_files))
     print(f"✅ Removed {total} comments.")
 
 
-def _compare(a: Path, b: Path, tmpdir: Path) -> bool:
+FULL_RES_SCALE = 150 / 72  # i.e. 150 dpi
+
+
+def _page_count(pdf: Path) -> int:
+    return len(pdfium.PdfDocument(pdf))
+
+
+def _render_page(pdf: Path, index: int, full_res: bool = False) -> np.ndarray:
+    """Render a single page (0-based index) into a pixel array."""
+    doc = pdfium.PdfDocument(pdf)
+    if full_res:
+        return doc[index].render(scale=FULL_RES_SCALE, rev_byteorder=True).to_numpy()
+    # 72 dpi grayscale moves ~12x fewer bytes per page and still catches
+    # every layout or content difference we care about.
+    return doc[index].render(scale=1, grayscale=True).to_numpy()
+
+
+def _write_pnm(path: Path, image: np.ndarray) -> None:
+    height, width, channels = image.shape
+    magic = "P6" if channels == 3 else "P5"
+    path.write_bytes(f"{magic}\n{width} {height}\n255\n".encode() + image.tobytes())
+
+
+def _file_digest(path: Path) -> bytes:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").digest()
+
+
+def _page_digest(args: Tuple[Path, int, bool]) -> bytes:
+    pdf, index, full_res = args
+    return hashlib.blake2b(
+        _render_page(pdf, index, full_res).tobytes(), digest_size=8
+    ).digest()
+
+
+def _compare(a: Path, b: Path, tmpdir: Path, full_res: bool = False) -> bool:
     print("🔍 Comparing PDFs for visual differences...")
-    (tmpdir / "a").mkdir(parents=True, exist_ok=True)
-    (tmpdir / "b").mkdir(parents=True, exist_ok=True)
 
-    print(f"⚙️ Converting {a} to PNGs...")
-    subprocess.run(["pdftoppm", "-png", a, tmpdir / "a" / "page"])
-    print(f"⚙️ Converting {b} to PNGs...")
-    subprocess.run(["pdftoppm", "-png", b, tmpdir / "b" / "page"])
+    for pdf in (a, b):
+        if not pdf.is_file():
+            print(f"❗ {pdf} does not exist.")
+            return False
 
-    a_pages = sorted(list((tmpdir / "a").glob("*")))
-    b_pages = sorted(list((tmpdir / "b").glob("*")))
+    if a.stat().st_size == b.stat().st_size and _file_digest(a) == _file_digest(b):
+        print("✅ PDFs are byte-identical.")
+        return True
 
-    if len(a_pages) != len(b_pages):
-        print(f"❗ {a} has {len(a_pages)} pages, {b} has {len(b_pages)} pages.")
+    a_count = _page_count(a)
+    b_count = _page_count(b)
+    if a_count != b_count:
+        print(f"❗ {a} has {a_count} pages, {b} has {b_count} pages.")
         return False
 
-    for i, (page_a, page_b) in enumerate(zip(a_pages, b_pages)):
-        image_a = Image.open(page_a)
-        image_b = Image.open(page_b)
-        diff = ImageChops.difference(image_a, image_b)
-        if image_a.size == image_b.size and diff.getbbox() is None:
-            pass
-        else:
-            print(f"❗ Visual difference on page {i}!")
-            return False
+    print(f"⚙️ Rendering and comparing {a_count} pages...")
+    with ProcessPoolExecutor() as executor:
+        digests_a = executor.map(
+            _page_digest,
+            ((a, index, full_res) for index in range(a_count)),
+            chunksize=4,
+        )
+        digests_b = executor.map(
+            _page_digest,
+            ((b, index, full_res) for index in range(b_count)),
+            chunksize=4,
+        )
+        for index, (digest_a, digest_b) in enumerate(zip(digests_a, digests_b)):
+            if digest_a != digest_b:
+                executor.shutdown(cancel_futures=True)
+                tmpdir.mkdir(parents=True, exist_ok=True)
+                name = f"page-{index + 1}.pnm"
+                _write_pnm(tmpdir / f"a-{name}", _render_page(a, index, full_res))
+                _write_pnm(tmpdir / f"b-{name}", _render_page(b, index, full_res))
+                print(f"❗ Visual difference on page {index + 1}! See {tmpdir}.")
+                return False
 
     print("✅ No visual differences found.")
     return True